@@ -1,20 +1,32 @@
 # app.py
 from fastapi import FastAPI, File, UploadFile, HTTPException, Form
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import JSONResponse
+from fastapi.staticfiles import StaticFiles
+from anyio import to_thread
 from ultralytics import YOLO
+from ultralytics.utils import ops
 import cv2
 import numpy as np
+import torch
+import torch.nn.functional as F
+import torchvision
+from torchvision.io import ImageReadMode
 import os
-import smtplib
 from email.message import EmailMessage
-import requests
+import httpx
+import importlib.util
+import aiosmtplib
 import time
+import string
+import warnings
 from datetime import datetime
 from pydantic import BaseModel
-from typing import Optional
+from typing import Optional, NamedTuple, Union
 from dotenv import load_dotenv
+import asyncio # For the batched inference worker and background alert tasks
 import uuid # For unique alert IDs
-import threading # For background alert cancellation logic
+import heapq # For O(log n) alert expiry ordering
+from collections import OrderedDict
 import json # For pretty printing API response in client
 
 # Load environment variables from .env file
@@ -22,17 +34,42 @@ load_dotenv()
 
 # --- Configuration (UPDATE THESE) ---
 # YOLO Model Path
-MODEL_PATH = "runs/detect/train/weights/best.pt" # Make sure this path is correct
-                                                  # e.g., if app.py is in the root, and best.pt is in subfolder, adjust.
+PT_MODEL_PATH = "runs/detect/train/weights/best.pt" # Make sure this path is correct
+                                                     # e.g., if app.py is in the root, and best.pt is in subfolder, adjust.
+ENGINE_MODEL_PATH = "runs/detect/train/weights/best.engine" # TensorRT FP16 engine built by export_engine.py
+# Prefer the TensorRT engine when it has been exported; fall back to the PyTorch checkpoint otherwise
+MODEL_PATH = ENGINE_MODEL_PATH if os.path.exists(ENGINE_MODEL_PATH) else PT_MODEL_PATH
 
 # Alerting Thresholds
 CRASH_CONF_THRESHOLD = 0.5  # Confidence score for a crash detection
 MIN_CRASH_DETECTIONS_REQUIRED = 3 # Number of consecutive frames with crash to trigger alert
 
+# Motion Gate
+MOTION_GATE_SIZE = 64 # Frames are compared as MOTION_GATE_SIZE x MOTION_GATE_SIZE grayscale thumbnails
+MOTION_GATE_THRESHOLD = 5.0 # Mean absolute pixel difference (0-255) below which a frame is treated as unchanged
+MAX_MOTION_GATE_CAMERAS = 1000 # Cap on remembered cameras; the least recently inferred is evicted first
+
+# Batched Inference
+MAX_INFERENCE_BATCH_SIZE = 8 # Max frames coalesced into a single YOLO call (keep in sync with export_engine.py)
+MAX_BATCH_WAIT_SECONDS = 0.02 # Max time the worker waits to fill a batch after the first frame arrives
+# anyio worker threads for Starlette's blocking calls (spooling large uploads to disk, StaticFiles reads).
+# Inference and annotated-image writes use asyncio's default executor and are not limited by this.
+THREADPOOL_SIZE = 2 * MAX_INFERENCE_BATCH_SIZE
+
+# GPU Decoding
+GPU_DECODE = torch.cuda.is_available() # Decode uploads with nvJPEG straight onto the GPU instead of cv2 on the CPU
+MODEL_INPUT_SIZE = 640 # Square size GPU-decoded frames are letterboxed to (matches the export imgsz)
+# decode_image wraps the read-only upload bytes in a tensor without copying; decode_jpeg never writes to it
+warnings.filterwarnings("ignore", message="The given buffer is not writable", category=UserWarning)
+
 # Emergency Contacts & Alert Settings
 # SMS Gateway (Fast2SMS Example)
 FAST2SMS_API_KEY = os.getenv("FAST2SMS_API_KEY") # Get from .env file
 FAST2SMS_SENDER_ID = os.getenv("FAST2SMS_SENDER_ID", "FSTSMS") # Default or get from .env
+FAST2SMS_URL = "https://www.fast2sms.com/devUtility/sms"
+# Static part of the Fast2SMS JSON body, serialised once; only message and numbers are filled in per alert
+# route "p" = Promotional route (usually free/cheaper for testing) - check Fast2SMS docs
+FAST2SMS_PAYLOAD_TEMPLATE = '{"sender_id":%s,"message":%%s,"language":"english","route":"p","numbers":%%s}' % json.dumps(FAST2SMS_SENDER_ID).replace("%", "%%") # Escape so a '%' in the env value isn't read as a directive later
 
 # Email Settings (Gmail Example)
 EMAIL_ADDRESS = os.getenv("EMAIL_ADDRESS")     # Your Gmail address (sender)
@@ -42,18 +79,98 @@ SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
 
 # Storage for annotated images
 ANNOTATED_IMAGES_DIR = "annotated_images"
+ANNOTATED_JPEG_QUALITY = 85
+MAX_ANNOTATED_IMAGES = 1000 # Oldest images beyond this count are deleted so the directory doesn't grow unbounded
+ANNOTATED_IMAGES_PRUNE_INTERVAL_SECONDS = 300
 os.makedirs(ANNOTATED_IMAGES_DIR, exist_ok=True)
 
 # --- Global State & Helper Classes ---
 # Store active alerts and their state
-active_alerts = {} # {alert_id: {"timestamp": datetime, "contact_number": str, "contact_email": str, "cancelled": bool, "detection_count": int, "image_path": str}}
+active_alerts = OrderedDict() # {alert_id: {"timestamp": datetime, "contact_number": str, "contact_email": str, "cancelled": bool, "detection_count": int, "image_path": str, "cancellation_check_pending": bool}}
+active_alerts_lock = asyncio.Lock() # Guards active_alerts across the endpoints and background alert tasks
+alert_expiry_heap = [] # Min-heap of (expiry_time, alert_id); expiry_time is on the time.monotonic() clock
+pending_alerts = OrderedDict() # Uncancelled, unexpired alert IDs in creation order (values unused)
 MAX_ALERT_PENDING_TIME_SECONDS = 60 # Time window for user to cancel alert
+MAX_ACTIVE_ALERTS = 1000 # Hard cap on active_alerts; the oldest alerts are evicted first
 
 # Location Info (UPDATE THIS for your specific location/demo)
 LOCATION_NAME = "Chennai OMR Road, Near Sholinganallur"
 LOCATION_LAT = 12.9126
 LOCATION_LON = 80.2281
 
+# Email alert body, filled in per alert with safe_substitute
+EMAIL_BODY_TEMPLATE = string.Template("""
+    Dear Emergency Contact,
+
+    An automated accident detection system (ResQ) has identified a potential road accident.
+
+    **Alert ID:** $alert_id
+    **Severity:** $severity
+    **Location:** $location_name
+                 Latitude: $location_lat, Longitude: $location_lon
+    **Timestamp:** $timestamp
+
+    Please check the ResQ dashboard for the annotated image and more details.
+    (If this is a false alarm, please cancel the alert on the dashboard within $pending_seconds seconds.)
+
+    ---
+    This is an automated message. Do not reply.
+    """)
+
+# Frames waiting for the batched inference worker
+class InferenceRequest(NamedTuple):
+    image: Union[np.ndarray, torch.Tensor]
+    future: asyncio.Future
+
+inference_queue: asyncio.Queue = asyncio.Queue()
+inference_worker_task: Optional[asyncio.Task] = None
+last_inferred_frames = OrderedDict() # {camera_key: (thumbnail, (crash_detected, severity, image_filename))} for the motion gate
+background_tasks = set() # Strong references so fire-and-forget tasks are not garbage collected mid-flight
+sms_client: Optional[httpx.AsyncClient] = None # Keep-alive Fast2SMS client, opened on startup and closed on shutdown
+
+class SmtpPool:
+    # One long-lived, logged-in SMTP connection shared by all email alerts.
+    # Connects lazily on first send and reconnects when the server has dropped the idle connection.
+    def __init__(self, hostname: str, port: int, username: Optional[str], password: Optional[str]):
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.password = password
+        self._smtp: Optional[aiosmtplib.SMTP] = None
+        self._lock = asyncio.Lock() # An SMTP session is a single conversation, so sends take turns
+
+    async def _connect(self):
+        smtp = aiosmtplib.SMTP(hostname=self.hostname, port=self.port, start_tls=True) # Secure the connection
+        await smtp.connect()
+        try:
+            await smtp.login(self.username, self.password)
+        except Exception:
+            smtp.close()
+            raise
+        self._smtp = smtp
+
+    async def send(self, msg: EmailMessage):
+        async with self._lock:
+            if self._smtp is None or not self._smtp.is_connected:
+                await self._connect()
+            try:
+                await self._smtp.send_message(msg)
+            except aiosmtplib.SMTPServerDisconnected:
+                # Server closed the connection while idle: log in again and retry once
+                await self._connect()
+                await self._smtp.send_message(msg)
+
+    async def close(self):
+        async with self._lock:
+            if self._smtp is not None and self._smtp.is_connected:
+                try:
+                    await self._smtp.quit()
+                except aiosmtplib.SMTPException:
+                    self._smtp.close()
+            self._smtp = None
+
+smtp_pool = SmtpPool(SMTP_SERVER, SMTP_PORT, EMAIL_ADDRESS, EMAIL_PASSWORD)
+
 class AlertPayload(BaseModel):
     contact_number: str
     contact_email: str
@@ -66,38 +183,209 @@ app = FastAPI(
     version="1.0.0",
 )
 
+# Annotated images are served by StaticFiles (ETag/Last-Modified, conditional requests) instead of a custom endpoint
+app.mount(f"/{ANNOTATED_IMAGES_DIR}", StaticFiles(directory=ANNOTATED_IMAGES_DIR), name="annotated_images")
+
 # Load YOLO model globally
 try:
-    model = YOLO(MODEL_PATH)
+    model = YOLO(MODEL_PATH, task="detect") # Ultralytics dispatches .engine files to the TensorRT backend
     print(f"INFO: YOLO model loaded successfully from {MODEL_PATH}")
 except Exception as e:
     print(f"ERROR: Failed to load YOLO model from {MODEL_PATH}: {e}")
     # Consider raising an exception here to prevent the app from starting if model is essential
     raise RuntimeError(f"YOLO model failed to load. Check MODEL_PATH: {MODEL_PATH}")
 
+# --- Batched Inference ---
+
+async def batch_inference_worker():
+    # Pops up to MAX_INFERENCE_BATCH_SIZE frames (or waits MAX_BATCH_WAIT_SECONDS) and runs them through YOLO in one call
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await inference_queue.get()]
+        batch_started = loop.time()
+        while len(batch) < MAX_INFERENCE_BATCH_SIZE and (loop.time() - batch_started) < MAX_BATCH_WAIT_SECONDS:
+            try:
+                batch.append(inference_queue.get_nowait())
+            except asyncio.QueueEmpty:
+                await asyncio.sleep(0.002)
+
+        images = [request.image for request in batch]
+        try:
+            # Run in the default executor so the event loop keeps accepting frames during inference.
+            # Letterboxed CUDA tensors share a shape, so they go in as one BCHW batch.
+            results = await loop.run_in_executor(None, lambda: model(torch.stack(images) if GPU_DECODE else images, verbose=False))
+        except Exception as e:
+            print(f"ERROR: Batched inference failed for {len(batch)} frame(s): {e}")
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+            continue
+
+        for request, result in zip(batch, results):
+            if not request.future.done(): # The client may have disconnected
+                request.future.set_result(result)
+
+async def run_inference(image: Union[np.ndarray, torch.Tensor]):
+    # Submit a frame to the batched inference worker and wait for its result
+    future = asyncio.get_running_loop().create_future()
+    await inference_queue.put(InferenceRequest(image, future))
+    return await future
+
+def launch_inference_worker():
+    global inference_worker_task
+    inference_worker_task = asyncio.create_task(batch_inference_worker())
+    inference_worker_task.add_done_callback(on_inference_worker_done)
+
+def on_inference_worker_done(task: asyncio.Task):
+    # Without a running worker every pending run_inference() would wait forever, so restart it after a crash
+    if task.cancelled(): # Normal shutdown
+        return
+    print(f"ERROR: Batched inference worker crashed: {task.exception()!r}. Restarting it.")
+    launch_inference_worker()
+
+@app.on_event("startup")
+async def start_inference_worker():
+    # Concurrency comes from batching in a single process, so cap Starlette's threadpool well below the default 40
+    to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    launch_inference_worker()
+    print(f"INFO: Batched inference worker started (max batch size {MAX_INFERENCE_BATCH_SIZE}).")
+
+@app.on_event("startup")
+async def open_sms_client():
+    global sms_client
+    headers = {
+        "Content-Type": "application/json",
+        "cache-control": "no-cache"
+    }
+    if FAST2SMS_API_KEY:
+        headers["authorization"] = FAST2SMS_API_KEY
+    # Reuses one keep-alive connection across alerts. HTTP/2 only if the optional h2 package is installed
+    # (pip install "httpx[http2]"); httpx raises ImportError at construction otherwise.
+    http2 = importlib.util.find_spec("h2") is not None
+    sms_client = httpx.AsyncClient(http2=http2, timeout=10, headers=headers)
+
+@app.on_event("startup")
+async def start_annotated_images_pruner():
+    spawn_background_task(annotated_images_pruner())
+
+@app.on_event("shutdown")
+async def close_sms_client():
+    if sms_client is not None:
+        await sms_client.aclose()
+
+@app.on_event("shutdown")
+async def close_smtp_pool():
+    await smtp_pool.close()
+
 # --- Helper Functions ---
 
-def send_sms_alert(phone_number: str, message: str):
+def prune_annotated_images():
+    # Delete the oldest annotated images (by modification time) beyond MAX_ANNOTATED_IMAGES
+    entries = [entry for entry in os.scandir(ANNOTATED_IMAGES_DIR) if entry.is_file()]
+    if len(entries) <= MAX_ANNOTATED_IMAGES:
+        return 0
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    removed = 0
+    for entry in entries[:len(entries) - MAX_ANNOTATED_IMAGES]:
+        try:
+            os.remove(entry.path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+async def annotated_images_pruner():
+    while True:
+        await asyncio.sleep(ANNOTATED_IMAGES_PRUNE_INTERVAL_SECONDS)
+        try:
+            removed = await asyncio.to_thread(prune_annotated_images)
+            if removed:
+                print(f"INFO: Pruned {removed} old annotated image(s) from {ANNOTATED_IMAGES_DIR}.")
+        except OSError as e:
+            print(f"ERROR: Failed to prune {ANNOTATED_IMAGES_DIR}: {e}")
+
+def expire_alerts(now: float):
+    # Pop alerts whose cancellation window has closed, oldest first, instead of scanning every alert per request.
+    # Caller must hold active_alerts_lock.
+    while alert_expiry_heap and alert_expiry_heap[0][0] <= now:
+        _, alert_id = heapq.heappop(alert_expiry_heap)
+        pending_alerts.pop(alert_id, None)
+        alert_data = active_alerts.get(alert_id)
+        # Only alerts with a scheduled check_alert_cancellation stay around for it to resolve; everything else
+        # (never dispatched, cancelled, or every send failed) is dropped here
+        if alert_data and not alert_data["cancellation_check_pending"]:
+            print(f"INFO: Alert {alert_id} expired without a pending cancellation check.")
+            del active_alerts[alert_id]
+
+def letterbox_tensor(img: torch.Tensor) -> torch.Tensor:
+    # Resize a CHW uint8 tensor to fit MODEL_INPUT_SIZE and pad it square (pad value 114, like Ultralytics' letterbox)
+    _, h, w = img.shape
+    scale = MODEL_INPUT_SIZE / max(h, w)
+    new_h, new_w = round(h * scale), round(w * scale)
+    resized = F.interpolate(img.unsqueeze(0).float(), size=(new_h, new_w), mode="bilinear", align_corners=False)
+    top = (MODEL_INPUT_SIZE - new_h) // 2
+    left = (MODEL_INPUT_SIZE - new_w) // 2
+    padded = resized.new_full((1, 3, MODEL_INPUT_SIZE, MODEL_INPUT_SIZE), 114.0)
+    padded[:, :, top:top + new_h, left:left + new_w] = resized
+    return padded[0].div_(255.0) # Ultralytics skips its own preprocessing for tensors, so normalise to 0-1 here
+
+def frame_thumbnail(image: Union[np.ndarray, torch.Tensor]):
+    # Tiny grayscale copy of the frame (0-255 scale) used to spot unchanged scenes
+    if isinstance(image, torch.Tensor):
+        # Same luma weights as cv2.COLOR_BGR2GRAY, applied to the unpadded RGB CHW uint8 frame -> 1x1xHxW
+        weights = torch.tensor([0.299, 0.587, 0.114], device=image.device).view(3, 1, 1)
+        gray = (image.float() * weights).sum(dim=0, keepdim=True).unsqueeze(0)
+        return F.interpolate(gray, size=(MOTION_GATE_SIZE, MOTION_GATE_SIZE), mode="area")[0, 0]
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, (MOTION_GATE_SIZE, MOTION_GATE_SIZE), interpolation=cv2.INTER_AREA)
+
+def frame_difference(a, b) -> float:
+    if isinstance(a, torch.Tensor):
+        return float((a - b).abs().mean())
+    return float(np.mean(cv2.absdiff(a, b)))
+
+def motion_gate_check(image: Union[np.ndarray, torch.Tensor], last_thumbnail):
+    # Returns (thumbnail, difference from last_thumbnail or None). Runs in a worker thread, since on the GPU path
+    # reading the difference back waits for queued CUDA work.
+    thumbnail = frame_thumbnail(image)
+    if last_thumbnail is None:
+        return thumbnail, None
+    return thumbnail, frame_difference(thumbnail, last_thumbnail)
+
+def decode_image(contents: bytes):
+    # Returns a BGR numpy image, or an RGB CHW uint8 CUDA tensor when GPU_DECODE is enabled. None if undecodable.
+    # GPU frames are letterboxed separately for the model, so the full-size frame stays available for annotation.
+    if len(contents) == 0:
+        return None
+    if not GPU_DECODE:
+        return cv2.imdecode(np.frombuffer(contents, np.uint8), cv2.IMREAD_COLOR)
+
+    try:
+        buf = torch.frombuffer(contents, dtype=torch.uint8) # decode_jpeg takes the encoded bytes as a CPU tensor
+        img = torchvision.io.decode_jpeg(buf, mode=ImageReadMode.RGB, device="cuda")
+    except RuntimeError:
+        # Not a JPEG (e.g. PNG upload): decode on the CPU and upload once
+        bgr = cv2.imdecode(np.frombuffer(contents, np.uint8), cv2.IMREAD_COLOR)
+        if bgr is None:
+            return None
+        img = torch.from_numpy(cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)).permute(2, 0, 1).cuda()
+    return img
+
+def spawn_background_task(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def send_sms_alert(phone_number: str, message: str):
     if not FAST2SMS_API_KEY:
         print("WARNING: FAST2SMS_API_KEY not set. SMS alert skipped.")
         return False
-    
-    url = "https://www.fast2sms.com/devUtility/sms"
-    headers = {
-        "authorization": FAST2SMS_API_KEY,
-        "Content-Type": "application/json",
-        "cache-control": "no-cache"
-    }
-    payload = json.dumps({
-        "sender_id": FAST2SMS_SENDER_ID,
-        "message": message,
-        "language": "english",
-        "route": "p", # Promotional route (usually free/cheaper for testing) - check Fast2SMS docs
-        "numbers": phone_number
-    })
+
+    payload = FAST2SMS_PAYLOAD_TEMPLATE % (json.dumps(message), json.dumps(phone_number))
     
     try:
-        response = requests.request("POST", url, headers=headers, data=payload, timeout=10)
+        response = await sms_client.post(FAST2SMS_URL, content=payload)
         response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
         sms_response = response.json()
         if sms_response.get("return"): # Fast2SMS returns "true" for success
@@ -106,14 +394,14 @@ def send_sms_alert(phone_number: str, message: str):
         else:
             print(f"ERROR: Failed to send SMS to {phone_number}: {sms_response}")
             return False
-    except requests.exceptions.Timeout:
+    except httpx.TimeoutException:
         print(f"ERROR: SMS request to {phone_number} timed out.")
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"ERROR: SMS sending failed for {phone_number}: {e}")
     return False
 
 
-def send_email_alert(recipient_email: str, subject: str, body: str):
+async def send_email_alert(recipient_email: str, subject: str, body: str):
     if not EMAIL_ADDRESS or not EMAIL_PASSWORD:
         print("WARNING: EMAIL_ADDRESS or EMAIL_PASSWORD not set. Email alert skipped.")
         return False
@@ -125,129 +413,162 @@ def send_email_alert(recipient_email: str, subject: str, body: str):
     msg["To"] = recipient_email
 
     try:
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as smtp:
-            smtp.starttls() # Secure the connection
-            smtp.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-            smtp.send_message(msg)
+        await smtp_pool.send(msg)
         print(f"INFO: Email alert sent successfully to {recipient_email}")
         return True
-    except smtplib.SMTPAuthenticationError:
+    except aiosmtplib.SMTPAuthenticationError:
         print(f"ERROR: Email authentication failed. Check EMAIL_ADDRESS and EMAIL_PASSWORD (App Password for Gmail).")
-    except smtplib.SMTPConnectError:
+    except aiosmtplib.SMTPConnectError:
         print(f"ERROR: Could not connect to SMTP server {SMTP_SERVER}:{SMTP_PORT}. Check server address and port.")
     except Exception as e:
         print(f"ERROR: Failed to send email to {recipient_email}: {e}")
     return False
 
-def process_detection(image: np.ndarray, contact_number: str, contact_email: str):
-    current_time = datetime.now()
-    frame_id = current_time.strftime("%Y%m%d%H%M%S%f") # Unique ID for frame
-
-    results = model(image) # Perform inference with YOLOv8
+def find_crashes(r, image: Union[np.ndarray, torch.Tensor]):
+    # Returns (n_crash, annotated BGR image or None). Runs in a worker thread: the mask sum and box/frame copies
+    # wait on the GPU, which would otherwise block the event loop until the in-flight batch finishes.
+
+    # Check if 'crashed_vehicle' (class 0 based on typical training) is in the results
+    # Assuming 'crashed_vehicle' is class_id = 0 as per common YOLO datasets / custom training
+    # You might need to adjust class_id based on your actual training
+    # Class and confidence are filtered with one tensor op: a single device->host sync per frame instead of per box
+    crash_mask = (r.boxes.cls == 0) & (r.boxes.conf > CRASH_CONF_THRESHOLD)
+    n_crash = int(crash_mask.sum())
+    if n_crash == 0: # Frames without crashes never reach the drawing below
+        return 0, None
+
+    # Draw the crash bounding boxes
+    # Plain OpenCV drawing of just the masked boxes is much cheaper than YOLOv8's r.plot()
+    crash_boxes = r.boxes.xyxy[crash_mask]
+    if GPU_DECODE:
+        # Boxes are in letterbox coordinates; map them back onto the uploaded frame and convert it to BGR for cv2
+        crash_boxes = ops.scale_boxes((MODEL_INPUT_SIZE, MODEL_INPUT_SIZE), crash_boxes.clone(), tuple(image.shape[1:]))
+        annotated_img = image.flip(0).permute(1, 2, 0).contiguous().cpu().numpy()
+    else:
+        annotated_img = image.copy() # Uploaded BGR frame
+    for x1, y1, x2, y2 in crash_boxes.round().int().cpu().tolist():
+        cv2.rectangle(annotated_img, (x1, y1), (x2, y2), (0, 0, 255), 2)
+        cv2.putText(annotated_img, "CRASH", (x1, max(y1 - 4, 0)), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
+    return n_crash, annotated_img
+
+async def detect_crash(image: Union[np.ndarray, torch.Tensor], frame_id: str):
+    # Runs YOLO on the frame; returns (crash_detected_in_frame, severity, annotated_image_filename)
+    model_input = await asyncio.to_thread(letterbox_tensor, image) if GPU_DECODE else image
+    r = await run_inference(model_input) # Perform batched inference with YOLOv8
+    n_crash, annotated_img = await asyncio.to_thread(find_crashes, r, image)
 
     crash_detected_in_frame = False
     annotated_image_filename = None
     severity = "none" # Default severity
 
-    for r in results:
-        # Check if 'crashed_vehicle' (class 0 based on typical training) is in the results
-        # Assuming 'crashed_vehicle' is class_id = 0 as per common YOLO datasets / custom training
-        # You might need to adjust class_id based on your actual training
-        detected_class_ids = [int(box.cls) for box in r.boxes]
-        
-        # Check for multiple detections or specific class ID
-        if 0 in detected_class_ids: # Assuming 'crashed_vehicle' is class 0
-            # Filter by confidence for 'crashed_vehicle'
-            filtered_boxes = [
-                box for box in r.boxes if int(box.cls) == 0 and float(box.conf) > CRASH_CONF_THRESHOLD
-            ]
-            if len(filtered_boxes) > 0:
-                crash_detected_in_frame = True
-                
-                # Determine severity based on number of detected crash objects or their size/overlap
-                # This is a simple example, refine as needed for your model
-                if len(filtered_boxes) >= 2:
-                    severity = "severe" # Multiple crash objects
-                elif len(filtered_boxes) == 1:
-                    severity = "moderate" # Single crash object
-                else:
-                    severity = "minor" # Less confident detection, or very small object
-
-                # Draw bounding boxes and save annotated image
-                annotated_img = r.plot() # YOLOv8's built-in plot method
-                annotated_image_filename = f"crash_detection_{frame_id}.jpg"
-                annotated_image_path = os.path.join(ANNOTATED_IMAGES_DIR, annotated_image_filename)
-                cv2.imwrite(annotated_image_path, annotated_img)
-                print(f"INFO: Annotated image saved to {annotated_image_path}")
-                break # Only need one detection to flag as crash
+    if n_crash > 0:
+        crash_detected_in_frame = True
 
-    # --- Alert Logic ---
-    if crash_detected_in_frame:
-        # Check if an active alert already exists that hasn't been cancelled
-        active_alert_id = None
-        for alert_id, alert_data in active_alerts.items():
-            if not alert_data["cancelled"] and (datetime.now() - alert_data["timestamp"]).total_seconds() < MAX_ALERT_PENDING_TIME_SECONDS:
-                active_alert_id = alert_id
-                break
-
-        if active_alert_id:
-            # Increment detection count for existing active alert
-            active_alerts[active_alert_id]["detection_count"] += 1
-            print(f"INFO: Existing alert {active_alert_id} - Consecutive detections: {active_alerts[active_alert_id]['detection_count']}")
-            if active_alerts[active_alert_id]["detection_count"] >= MIN_CRASH_DETECTIONS_REQUIRED and not active_alerts[active_alert_id].get("alert_sent"):
-                # Send actual alerts only after consecutive detections
-                threading.Thread(target=trigger_emergency_alerts, args=(active_alert_id, active_alerts[active_alert_id])).start()
-                active_alerts[active_alert_id]["alert_sent"] = True # Mark as sent
+        # Determine severity based on number of detected crash objects or their size/overlap
+        # This is a simple example, refine as needed for your model
+        if n_crash >= 2:
+            severity = "severe" # Multiple crash objects
+        elif n_crash == 1:
+            severity = "moderate" # Single crash object
         else:
-            # New potential alert, create a new entry
-            new_alert_id = str(uuid.uuid4())
-            active_alerts[new_alert_id] = {
-                "timestamp": current_time,
-                "contact_number": contact_number,
-                "contact_email": contact_email,
-                "cancelled": False,
-                "detection_count": 1,
-                "image_path": annotated_image_filename, # Store filename only
-                "severity": severity,
-                "alert_sent": False # To track if alerts have been dispatched
-            }
-            print(f"INFO: New potential alert created: {new_alert_id}")
-            # If MIN_CRASH_DETECTIONS_REQUIRED is 1, trigger immediately
-            if MIN_CRASH_DETECTIONS_REQUIRED == 1:
-                threading.Thread(target=trigger_emergency_alerts, args=(new_alert_id, active_alerts[new_alert_id])).start()
-                active_alerts[new_alert_id]["alert_sent"] = True
-
-        return {
-            "crash_detected": True,
-            "alert_id": active_alert_id if active_alert_id else new_alert_id,
-            "message": "Crash detected! Alert pending.",
-            "image_url": f"/{ANNOTATED_IMAGES_DIR}/{annotated_image_filename}" if annotated_image_filename else None,
-            "severity": severity
-        }
+            severity = "minor" # Less confident detection, or very small object
+
+        # Save annotated image
+        annotated_image_filename = f"crash_detection_{frame_id}.jpg"
+        annotated_image_path = os.path.join(ANNOTATED_IMAGES_DIR, annotated_image_filename)
+        # Encode + write in a worker thread so the response doesn't wait on JPEG encoding and disk I/O
+        spawn_background_task(asyncio.to_thread(cv2.imwrite, annotated_image_path, annotated_img, [cv2.IMWRITE_JPEG_QUALITY, ANNOTATED_JPEG_QUALITY]))
+        print(f"INFO: Annotated image queued for saving to {annotated_image_path}")
+
+    return crash_detected_in_frame, severity, annotated_image_filename
+
+async def process_detection(image: Union[np.ndarray, torch.Tensor], contact_number: str, contact_email: str, camera_id: Optional[str] = None):
+    now_mono = time.monotonic() # One clock read per frame, reused for all expiry bookkeeping below
+    frame_id = str(time.time_ns()) # Unique ID for frame
+
+    # Skip YOLO when the scene hasn't changed since the last frame this camera had inferred, and reuse that verdict.
+    # Reusing (rather than reporting "no crash") keeps a static crash scene counting towards MIN_CRASH_DETECTIONS_REQUIRED.
+    # Frames are only comparable when they come from the same camera. Clients that don't send camera_id fall back to
+    # contact_number, which every camera reporting to the same contact shares: their frames then get diffed against
+    # each other, so the gate rarely fires and can reuse another camera's verdict and image.
+    camera_key = camera_id or contact_number
+    last_frame = last_inferred_frames.get(camera_key)
+    thumbnail, difference = await asyncio.to_thread(motion_gate_check, image, last_frame[0] if last_frame else None)
+    if difference is not None and difference < MOTION_GATE_THRESHOLD:
+        crash_detected_in_frame, severity, annotated_image_filename = last_frame[1]
     else:
-        # No crash detected, reset consecutive count for all active alerts (if any)
-        # Or, invalidate old alerts
-        alerts_to_remove = []
-        for alert_id, alert_data in active_alerts.items():
-            if not alert_data["cancelled"] and (datetime.now() - alert_data["timestamp"]).total_seconds() >= MAX_ALERT_PENDING_TIME_SECONDS:
-                alerts_to_remove.append(alert_id)
-            # Optionally, reset detection count if no crash in current frame
-            # alert_data["detection_count"] = 0 # This might make it too sensitive to single missed frames
-        
-        for alert_id in alerts_to_remove:
-            print(f"INFO: Alert {alert_id} expired without cancellation or dispatch.")
-            del active_alerts[alert_id]
+        crash_detected_in_frame, severity, annotated_image_filename = await detect_crash(image, frame_id)
+        last_inferred_frames[camera_key] = (thumbnail, (crash_detected_in_frame, severity, annotated_image_filename))
+        last_inferred_frames.move_to_end(camera_key)
+        # camera_key comes from the client, so bound the cache like active_alerts
+        while len(last_inferred_frames) > MAX_MOTION_GATE_CAMERAS:
+            last_inferred_frames.popitem(last=False)
 
-        return {
-            "crash_detected": False,
-            "message": "No crash detected.",
-            "alert_id": None,
-            "image_url": None,
-            "severity": "none"
-        }
+    # --- Alert Logic ---
+    async with active_alerts_lock:
+        expire_alerts(now_mono)
+
+        if crash_detected_in_frame:
+            # Check if an active alert already exists that hasn't been cancelled (oldest pending alert wins)
+            active_alert_id = next(iter(pending_alerts), None)
+
+            if active_alert_id:
+                # Increment detection count for existing active alert
+                active_alerts[active_alert_id]["detection_count"] += 1
+                print(f"INFO: Existing alert {active_alert_id} - Consecutive detections: {active_alerts[active_alert_id]['detection_count']}")
+                if active_alerts[active_alert_id]["detection_count"] >= MIN_CRASH_DETECTIONS_REQUIRED and not active_alerts[active_alert_id].get("alert_sent"):
+                    # Send actual alerts only after consecutive detections
+                    spawn_background_task(trigger_emergency_alerts(active_alert_id, active_alerts[active_alert_id]))
+                    active_alerts[active_alert_id]["alert_sent"] = True # Mark as sent
+            else:
+                # New potential alert, create a new entry
+                new_alert_id = str(uuid.uuid4())
+                # FIFO cap so a misbehaving stream can't grow active_alerts without bound
+                while len(active_alerts) >= MAX_ACTIVE_ALERTS:
+                    evicted_alert_id, _ = active_alerts.popitem(last=False)
+                    pending_alerts.pop(evicted_alert_id, None)
+                    print(f"WARNING: Alert {evicted_alert_id} evicted, active_alerts reached its cap of {MAX_ACTIVE_ALERTS}.")
+                active_alerts[new_alert_id] = {
+                    "timestamp": datetime.now(), # Wall-clock time, only used for display (expiry runs off alert_expiry_heap)
+                    "contact_number": contact_number,
+                    "contact_email": contact_email,
+                    "cancelled": False,
+                    "detection_count": 1,
+                    "image_path": annotated_image_filename, # Store filename only
+                    "severity": severity,
+                    "alert_sent": False, # To track if alerts have been dispatched
+                    "cancellation_check_pending": False # Set once check_alert_cancellation is scheduled
+                }
+                heapq.heappush(alert_expiry_heap, (now_mono + MAX_ALERT_PENDING_TIME_SECONDS, new_alert_id))
+                pending_alerts[new_alert_id] = None
+                print(f"INFO: New potential alert created: {new_alert_id}")
+                # If MIN_CRASH_DETECTIONS_REQUIRED is 1, trigger immediately
+                if MIN_CRASH_DETECTIONS_REQUIRED == 1:
+                    spawn_background_task(trigger_emergency_alerts(new_alert_id, active_alerts[new_alert_id]))
+                    active_alerts[new_alert_id]["alert_sent"] = True
+
+            return {
+                "crash_detected": True,
+                "alert_id": active_alert_id if active_alert_id else new_alert_id,
+                "message": "Crash detected! Alert pending.",
+                "image_url": f"/{ANNOTATED_IMAGES_DIR}/{annotated_image_filename}" if annotated_image_filename else None,
+                "severity": severity
+            }
+        else:
+            # No crash detected; old alerts were already invalidated by expire_alerts above
+            # Optionally, reset detection count for pending alerts if no crash in current frame
+            # (This might make it too sensitive to single missed frames)
+
+            return {
+                "crash_detected": False,
+                "message": "No crash detected.",
+                "alert_id": None,
+                "image_url": None,
+                "severity": "none"
+            }
 
-def trigger_emergency_alerts(alert_id: str, alert_data: dict):
-    # This function runs in a separate thread
+async def trigger_emergency_alerts(alert_id: str, alert_data: dict):
+    # This coroutine runs as a background task on the event loop
     contact_number = alert_data["contact_number"]
     contact_email = alert_data["contact_email"]
     severity = alert_data["severity"].upper()
@@ -255,47 +576,51 @@ def trigger_emergency_alerts(alert_id: str, alert_data: dict):
 
     sms_message = f"EMERGENCY: Road Accident Detected! Severity: {severity}. Location: {LOCATION_NAME} ({LOCATION_LAT}, {LOCATION_LON}). View image: {alert_id} - CHECK DASHBOARD." # Add dynamic URL later
     email_subject = f"ResQ ALERT: Critical Road Accident Detected - ID {alert_id} (Severity: {severity})"
-    email_body = f"""
-    Dear Emergency Contact,
-
-    An automated accident detection system (ResQ) has identified a potential road accident.
-
-    **Alert ID:** {alert_id}
-    **Severity:** {severity}
-    **Location:** {LOCATION_NAME}
-                 Latitude: {LOCATION_LAT}, Longitude: {LOCATION_LON}
-    **Timestamp:** {alert_data["timestamp"].strftime("%Y-%m-%d %H:%M:%S")}
+    email_body = EMAIL_BODY_TEMPLATE.safe_substitute(
+        alert_id=alert_id,
+        severity=severity,
+        location_name=LOCATION_NAME,
+        location_lat=LOCATION_LAT,
+        location_lon=LOCATION_LON,
+        timestamp=alert_data["timestamp"].strftime("%Y-%m-%d %H:%M:%S"),
+        pending_seconds=MAX_ALERT_PENDING_TIME_SECONDS,
+    )
 
-    Please check the ResQ dashboard for the annotated image and more details.
-    (If this is a false alarm, please cancel the alert on the dashboard within {MAX_ALERT_PENDING_TIME_SECONDS} seconds.)
-
-    ---
-    This is an automated message. Do not reply.
-    """
-    
     print(f"\n--- TRIGGERING ALERTS for {alert_id} ---")
-    sms_sent = send_sms_alert(contact_number, sms_message)
-    email_sent = send_email_alert(contact_email, email_subject, email_body)
+    # SMS and email are independent network round-trips, so send them concurrently
+    sms_sent, email_sent = await asyncio.gather(
+        send_sms_alert(contact_number, sms_message),
+        send_email_alert(contact_email, email_subject, email_body),
+        return_exceptions=True,
+    )
+    sms_sent = sms_sent is True # An exception counts as a failed send
+    email_sent = email_sent is True
 
     if sms_sent or email_sent:
         print(f"INFO: Emergency alerts dispatched for {alert_id}.")
         # Schedule a check to see if alert was cancelled after pending time
-        threading.Timer(MAX_ALERT_PENDING_TIME_SECONDS, check_alert_cancellation, args=[alert_id]).start()
+        async with active_alerts_lock:
+            if alert_id in active_alerts: # It may have expired or been evicted while the sends were in flight
+                active_alerts[alert_id]["cancellation_check_pending"] = True
+                spawn_background_task(check_alert_cancellation(alert_id))
     else:
         print(f"ERROR: No alerts were successfully sent for {alert_id}.")
 
-def check_alert_cancellation(alert_id: str):
-    if alert_id in active_alerts:
-        if not active_alerts[alert_id]["cancelled"]:
-            print(f"INFO: Alert {alert_id} was NOT cancelled by user within {MAX_ALERT_PENDING_TIME_SECONDS} seconds. Assuming confirmed incident.")
-            # Here you might add logic for escalated alerts, logging to a database, etc.
+async def check_alert_cancellation(alert_id: str):
+    await asyncio.sleep(MAX_ALERT_PENDING_TIME_SECONDS) # Give the user the full window to cancel
+    async with active_alerts_lock:
+        if alert_id in active_alerts:
+            if not active_alerts[alert_id]["cancelled"]:
+                print(f"INFO: Alert {alert_id} was NOT cancelled by user within {MAX_ALERT_PENDING_TIME_SECONDS} seconds. Assuming confirmed incident.")
+                # Here you might add logic for escalated alerts, logging to a database, etc.
+            else:
+                print(f"INFO: Alert {alert_id} was successfully cancelled by user.")
+
+            # Clean up expired/handled alert from active_alerts dictionary (safe under active_alerts_lock)
+            del active_alerts[alert_id]
+            pending_alerts.pop(alert_id, None)
         else:
-            print(f"INFO: Alert {alert_id} was successfully cancelled by user.")
-        
-        # Clean up expired/handled alert from active_alerts dictionary
-        # del active_alerts[alert_id] # Be careful with deletion if other threads might still access it
-    else:
-        print(f"WARNING: Alert {alert_id} not found in active_alerts during cancellation check.")
+            print(f"WARNING: Alert {alert_id} not found in active_alerts during cancellation check.")
 
 # --- API Endpoints ---
 
@@ -307,19 +632,19 @@ async def read_root():
 async def detect_and_alert(
     file: UploadFile = File(...),
     contact_number: str = Form(...),
-    contact_email: str = Form(...)
+    contact_email: str = Form(...),
+    camera_id: Optional[str] = Form(None) # Identifies the sending camera for the motion gate; optional for older clients
 ):
     try:
         # Read image
         contents = await file.read()
-        nparr = np.frombuffer(contents, np.uint8)
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        image = await asyncio.to_thread(decode_image, contents) # Off the loop: GPU decode can wait on in-flight inference
 
         if image is None:
             raise HTTPException(status_code=400, detail="Could not decode image.")
         
         # Process detection and alert logic
-        response_data = process_detection(image, contact_number, contact_email)
+        response_data = await process_detection(image, contact_number, contact_email, camera_id)
         
         return JSONResponse(content=response_data)
 
@@ -329,33 +654,31 @@ async def detect_and_alert(
         print(f"Unhandled error in /detect_and_alert/: {e}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-@app.get("/annotated_images/{image_name}")
-async def get_annotated_image(image_name: str):
-    image_path = os.path.join(ANNOTATED_IMAGES_DIR, image_name)
-    if not os.path.exists(image_path):
-        raise HTTPException(status_code=404, detail="Image not found.")
-    return FileResponse(image_path, media_type="image/jpeg")
-
 @app.post("/cancel_alert/{alert_id}")
 async def cancel_alert(alert_id: str):
-    if alert_id in active_alerts:
-        if not active_alerts[alert_id]["cancelled"]:
-            active_alerts[alert_id]["cancelled"] = True
-            print(f"INFO: Alert {alert_id} has been successfully marked as CANCELLED by user.")
-            return {"message": f"Alert {alert_id} cancelled successfully."}
+    async with active_alerts_lock:
+        if alert_id in active_alerts:
+            if not active_alerts[alert_id]["cancelled"]:
+                active_alerts[alert_id]["cancelled"] = True
+                pending_alerts.pop(alert_id, None)
+                print(f"INFO: Alert {alert_id} has been successfully marked as CANCELLED by user.")
+                return {"message": f"Alert {alert_id} cancelled successfully."}
+            else:
+                return {"message": f"Alert {alert_id} was already cancelled.", "status": "already_cancelled"}
         else:
-            return {"message": f"Alert {alert_id} was already cancelled.", "status": "already_cancelled"}
-    else:
-        raise HTTPException(status_code=404, detail=f"Alert ID {alert_id} not found or has expired.")
+            raise HTTPException(status_code=404, detail=f"Alert ID {alert_id} not found or has expired.")
 
 @app.get("/alert_status/{alert_id}")
 async def get_alert_status(alert_id: str):
-    alert_data = active_alerts.get(alert_id)
+    async with active_alerts_lock:
+        expire_alerts(time.monotonic())
+        alert_data = active_alerts.get(alert_id)
+        active = alert_id in pending_alerts
     if alert_data:
         # Provide a simplified status for frontend polling
         return {
             "alert_id": alert_id,
-            "active": not alert_data["cancelled"] and (datetime.now() - alert_data["timestamp"]).total_seconds() < MAX_ALERT_PENDING_TIME_SECONDS,
+            "active": active,
             "cancelled": alert_data["cancelled"],
             "alert_sent": alert_data.get("alert_sent", False),
             "severity": alert_data["severity"],
@@ -375,8 +698,10 @@ async def get_all_active_alerts():
     Returns a list of all currently active (not cancelled, not expired) alerts.
     """
     current_active = {}
-    for alert_id, alert_data in active_alerts.items():
-        if not alert_data["cancelled"] and (datetime.now() - alert_data["timestamp"]).total_seconds() < MAX_ALERT_PENDING_TIME_SECONDS:
+    async with active_alerts_lock:
+        expire_alerts(time.monotonic())
+        for alert_id in pending_alerts:
+            alert_data = active_alerts[alert_id]
             current_active[alert_id] = {
                 "alert_id": alert_id,
                 "cancelled": alert_data["cancelled"],
@@ -388,4 +713,12 @@ async def get_all_active_alerts():
                 "location_lat": LOCATION_LAT,
                 "location_lon": LOCATION_LON
             }
-    return JSONResponse(content=current_active)
\ No newline at end of file
+    return JSONResponse(content=current_active)
+
+if __name__ == "__main__":
+    import uvicorn
+    # Keep a single worker: each extra process would load its own copy of the model and CUDA context into VRAM,
+    # and split the incoming frames so the batching worker has less to coalesce.
+    # Pass the app object, not "app:app": an import string would re-import this module and load the model a second time.
+    # "auto" picks uvloop/httptools when installed (uvloop is unavailable on Windows) and falls back otherwise
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="auto", http="auto")
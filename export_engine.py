@@ -0,0 +1,22 @@
+# export_engine.py
+# Offline step: converts the trained YOLO checkpoint into a TensorRT FP16 engine.
+# app.py loads the resulting best.engine automatically when it exists.
+from ultralytics import YOLO
+
+PT_MODEL_PATH = "runs/detect/train/weights/best.pt" # Same checkpoint as PT_MODEL_PATH in app.py
+IMAGE_SIZE = 640
+MAX_BATCH = 8 # Must be >= MAX_INFERENCE_BATCH_SIZE in app.py
+WORKSPACE_GB = 4
+
+if __name__ == "__main__":
+    model = YOLO(PT_MODEL_PATH)
+    # dynamic=True lets the same engine serve any batch size from 1 to MAX_BATCH
+    engine_path = model.export(
+        format="engine",
+        imgsz=IMAGE_SIZE,
+        half=True,
+        dynamic=True,
+        batch=MAX_BATCH,
+        workspace=WORKSPACE_GB,
+    )
+    print(f"INFO: TensorRT engine exported to {engine_path}")